@@ -1,16 +1,49 @@
 from fastapi import FastAPI, HTTPException, Body
 from typing import Union
 from pydantic import BaseModel, HttpUrl
+from urllib.parse import urlsplit
 
+import hashlib
 import math
 import re
 import os
 import tempfile
-import subprocess
-import requests
+import asyncio
+import httpx
+
+# Optional: numba compiles the E-axis accumulator to native code. The pure
+# Python byte-scanning loop below stays as the fallback when numba isn't
+# installed.
+try:
+    import numpy as np
+    from numba import njit
+except ImportError:
+    np = None
+    njit = None
 
 app = FastAPI()
 
+# Precompiled patterns (module load) so the per-line loops below never pay
+# re's cache lookup on every call.
+# One alternation each for the gram and length summary variants, so a
+# line is tested with a single .search instead of three.
+# Grams: "filament used [g] = 1.2" / "filament used = 1.2 g" / "Filament used: 1.2g"
+_GRAM_RE = re.compile(
+    r"filament used\s*(?:\[g\]\s*=\s*([0-9.]+)|[:=]\s*([0-9.]+)\s*g)",
+    re.IGNORECASE,
+)
+# Length: "filament used [mm] = 1.2" / "filament used = 1.2 mm" / "filament used = 1.2 m"
+_LEN_RE = re.compile(
+    r"filament used\s*(?:\[mm\]\s*=\s*([0-9.]+)|=\s*([0-9.]+)\s*(mm|m\b))",
+    re.IGNORECASE,
+)
+_TIME_RE = re.compile(r"estimated printing time.*=\s*([0-9hms\s]+)", re.IGNORECASE)
+_TIME_UNITS_RE = re.compile(r"(\d+)\s*([hms])")
+_TIME_UNIT_SECONDS = {"h": 3600, "m": 60, "s": 1}
+
+
+_ALLOWED_EXTS = (".stl", ".3mf")
+
 
 class Req(BaseModel):
     file_url: HttpUrl
@@ -34,7 +67,128 @@ def _calc_grams_from_length_mm(length_mm: float, material: str, filament_diamete
     return volume_cm3 * density
 
 
-def _extrusion_length_mm_from_e_axis(gcode: str) -> float:
+# numba path buffers the whole file; above this size stay on the
+# streaming fallback so huge prints keep their flat memory profile
+_NUMBA_MAX_BYTES = 1 << 28
+
+
+def _e_axis_kernel(buf):
+    # Same state machine as the fallback loop below, hand-rolled over raw
+    # bytes (incl. the float parse) so numba can compile it without any
+    # string or regex objects.
+    absolute = True
+    e_pos = 0.0
+    total = 0.0
+    n = buf.shape[0]
+    i = 0
+    while i < n:
+        j = i
+        while j < n and buf[j] != 10:  # '\n'
+            j += 1
+
+        c = buf[i] if i < j else 0
+        is_move = False
+        is_reset = False
+        if c == 77 and j - i >= 3 and buf[i + 1] == 56:  # 'M8...'
+            if buf[i + 2] == 50:  # M82
+                absolute = True
+            elif buf[i + 2] == 51:  # M83
+                absolute = False
+        elif c == 71 and j - i >= 2:  # 'G'
+            b1 = buf[i + 1]
+            is_move = b1 == 48 or b1 == 49  # G0 / G1
+            is_reset = b1 == 57 and j - i >= 3 and buf[i + 2] == 50  # G92
+
+        if is_move or is_reset:
+            k = i + 1
+            val = 0.0
+            found = False
+            while k < j:
+                ch = buf[k]
+                if ch == 59:  # ';' starts an inline comment
+                    break
+                if ch == 69 or ch == 101:  # 'E' / 'e'
+                    p = k + 1
+                    sign = 1.0
+                    if p < j and buf[p] == 45:  # '-'
+                        sign = -1.0
+                        p += 1
+                    intpart = 0.0
+                    ndig = 0
+                    while p < j and 48 <= buf[p] <= 57:
+                        intpart = intpart * 10.0 + (buf[p] - 48)
+                        ndig += 1
+                        p += 1
+                    frac = 0.0
+                    scale = 1.0
+                    if p < j and buf[p] == 46:  # '.'
+                        p += 1
+                        while p < j and 48 <= buf[p] <= 57:
+                            frac = frac * 10.0 + (buf[p] - 48)
+                            scale *= 10.0
+                            ndig += 1
+                            p += 1
+                    if ndig > 0:
+                        val = sign * (intpart + frac / scale)
+                        found = True
+                        break
+                    k = p
+                    continue
+                k += 1
+
+            if found:
+                if is_reset:
+                    e_pos = val
+                elif absolute:
+                    delta = val - e_pos
+                    e_pos = val
+                    if delta > 0.0:
+                        total += delta
+                elif val > 0.0:
+                    total += val
+
+        i = j + 1
+
+    return total if total > 0.0 else 0.0
+
+
+if njit is not None:
+    _e_axis_kernel = njit(cache=True)(_e_axis_kernel)
+
+
+def _e_value(line: bytes):
+    """
+    Value of the first E/e token in a (binary, comment-stripped) line, or
+    None. Equivalent to searching rb"[Ee](-?\\d*\\.?\\d+)" but locates the
+    token with C-level find/slice instead of the regex engine.
+    """
+    n = len(line)
+    i = 0
+    while True:
+        k = line.find(b"E", i)
+        ke = line.find(b"e", i)
+        if k < 0 or (0 <= ke < k):
+            k = ke
+        if k < 0:
+            return None
+        j = k + 1
+        if j < n and line[j] == 45:  # '-'
+            j += 1
+        digits = 0
+        while j < n and 48 <= line[j] <= 57:
+            digits += 1
+            j += 1
+        if j < n and line[j] == 46:  # '.'
+            j += 1
+            while j < n and 48 <= line[j] <= 57:
+                digits += 1
+                j += 1
+        if digits:
+            return float(line[k + 1:j])
+        i = k + 1
+
+
+def _extrusion_length_mm_from_e_axis(gcode_path: str) -> float:
     """
     Compute filament length from the E axis (mm of filament).
     Supports:
@@ -44,133 +198,284 @@ def _extrusion_length_mm_from_e_axis(gcode: str) -> float:
       - E.20855 (no leading 0)
       - lowercase e
       - inline comments
+
+    Streams the file in one pass; the G-code is never held in memory whole.
     """
+    if njit is not None and os.path.getsize(gcode_path) <= _NUMBA_MAX_BYTES:
+        with open(gcode_path, "rb") as f:
+            return _e_axis_kernel(np.frombuffer(f.read(), dtype=np.uint8))
+
     absolute = True
     e_pos = 0.0
     total = 0.0
 
-    # Case-insensitive E/e
-    e_re = re.compile(r"[Ee](-?\d*\.?\d+)")
-
-    for raw in gcode.splitlines():
-        # remove inline comments
-        line = raw.split(";", 1)[0].strip()
-        if not line:
-            continue
-
-        # mode changes
-        if line.startswith("M82"):
-            absolute = True
-            continue
-        if line.startswith("M83"):
-            absolute = False
-            continue
-
-        # reset extruder
-        if line.startswith("G92"):
-            m = e_re.search(line)
-            if m:
-                e_pos = float(m.group(1))
-            continue
-
-        # only consider move commands
-        if not (line.startswith("G0") or line.startswith("G1")):
-            continue
-
-        m = e_re.search(line)
-        if not m:
-            continue
-
-        e_val = float(m.group(1))
-
-        if absolute:
-            delta = e_val - e_pos
-            e_pos = e_val
-            if delta > 0:
-                total += delta
-        else:
-            if e_val > 0:
-                total += e_val
+    with open(gcode_path, "rb", buffering=1 << 20) as f:
+        for raw in f:
+            # Cheap first-byte check: everything but G/M commands (comments,
+            # blank lines) is rejected before any splitting or regex work.
+            c = raw[:1]
+            if c != b"G" and c != b"M":
+                continue
+
+            # remove inline comments
+            line = raw.split(b";", 1)[0]
+
+            # mode changes
+            if line.startswith(b"M82"):
+                absolute = True
+                continue
+            if line.startswith(b"M83"):
+                absolute = False
+                continue
+            if c == b"M":
+                continue
+
+            # reset extruder
+            if line.startswith(b"G92"):
+                v = _e_value(line)
+                if v is not None:
+                    e_pos = v
+                continue
+
+            # only consider move commands
+            if not (line.startswith(b"G0") or line.startswith(b"G1")):
+                continue
+
+            # most moves carry no E token at all; the containment test
+            # rejects them before even the manual scan runs
+            if b"E" not in line and b"e" not in line:
+                continue
+
+            e_val = _e_value(line)
+            if e_val is None:
+                continue
+
+            if absolute:
+                delta = e_val - e_pos
+                e_pos = e_val
+                if delta > 0:
+                    total += delta
+            else:
+                if e_val > 0:
+                    total += e_val
 
     return max(0.0, total)
 
 
 
 
-def parse_filament_g(gcode: str, material: str = "PLA", filament_diameter_mm: float = 1.75) -> float:
-    # 1) Try grams directly (if slicer included it)
-    gram_patterns = [
-        r"filament used \[g\]\s*=\s*([0-9.]+)",
-        r"filament used\s*=\s*([0-9.]+)\s*g",
-        r"Filament used:\s*([0-9.]+)\s*g",
-    ]
-    for line in gcode.splitlines():
-        for p in gram_patterns:
-            m = re.search(p, line, re.IGNORECASE)
-            if m:
-                return float(m.group(1))
+def _read_tail(path: str, n: int = 65536) -> str:
+    # PrusaSlicer writes its summary comments in the trailing footer, so a
+    # bounded tail read finds them without walking millions of move lines.
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        if size > n:
+            f.seek(size - n)
+        return f.read().decode("utf-8", errors="ignore")
+
 
-    # 2) Try length summary (mm or m), then convert to grams
+def _filament_summary(lines):
+    # Single pass over lines: grams win over a length summary, wherever
+    # each of them appears.
     length_mm = None
-    length_patterns = [
-        (r"filament used \[mm\]\s*=\s*([0-9.]+)", "mm"),
-        (r"filament used\s*=\s*([0-9.]+)\s*mm", "mm"),
-        (r"filament used\s*=\s*([0-9.]+)\s*m\b", "m"),
-    ]
-    for line in gcode.splitlines():
-        for p, unit in length_patterns:
-            m = re.search(p, line, re.IGNORECASE)
+    for line in lines:
+        # summaries are always comment lines (e.g. "; filament used [g] = ...");
+        # a startswith check keeps move lines away from the regexes entirely
+        if not line.startswith(";"):
+            continue
+        m = _GRAM_RE.search(line)
+        if m:
+            return float(m.group(1) or m.group(2)), length_mm
+        if length_mm is None:
+            m = _LEN_RE.search(line)
             if m:
-                val = float(m.group(1))
-                length_mm = val * 1000.0 if unit == "m" else val
-                break
-        if length_mm is not None:
-            break
+                if m.group(1) is not None:
+                    length_mm = float(m.group(1))
+                else:
+                    val = float(m.group(2))
+                    length_mm = val * 1000.0 if m.group(3).lower() == "m" else val
+    return None, length_mm
+
+
+def parse_filament_g(gcode_path: str, material: str = "PLA", filament_diameter_mm: float = 1.75) -> float:
+    # 1) Try grams directly (if slicer included it), 2) else a length
+    # summary (mm or m). Check the tail first; fall back to a full scan
+    # only when the footer had no summary at all.
+    grams, length_mm = _filament_summary(_read_tail(gcode_path).splitlines())
+    if grams is None and length_mm is None:
+        with open(gcode_path, "r", encoding="utf-8", errors="ignore") as f:
+            grams, length_mm = _filament_summary(f)
+
+    if grams is not None:
+        return grams
 
     if length_mm is not None:
         return _calc_grams_from_length_mm(length_mm, material, filament_diameter_mm)
 
     # 3) Final fallback: compute length from E axis values
-    e_length_mm = _extrusion_length_mm_from_e_axis(gcode)
+    e_length_mm = _extrusion_length_mm_from_e_axis(gcode_path)
     if e_length_mm <= 0:
         return 0.0
 
     return _calc_grams_from_length_mm(e_length_mm, material, filament_diameter_mm)
 
 
-def parse_time_seconds(txt: str) -> int:
-    m = re.search(r"estimated printing time.*=\s*([0-9hms\s]+)", txt, re.IGNORECASE)
+def _time_seconds_from_text(txt: str) -> int:
+    # The marker is a footer line; locate it with a C-level find (the first
+    # occurrence is the normal-mode estimate on dual-mode printers) and let
+    # the regex look at a 256-char window instead of the whole text.
+    idx = txt.lower().find("estimated printing time")
+    if idx < 0:
+        return -1
+    m = _TIME_RE.search(txt[idx:idx + 256])
     if not m:
         return -1
-    s = m.group(1)
-    h = int(re.search(r"(\d+)\s*h", s).group(1)) if re.search(r"(\d+)\s*h", s) else 0
-    m_ = int(re.search(r"(\d+)\s*m", s).group(1)) if re.search(r"(\d+)\s*m", s) else 0
-    se = int(re.search(r"(\d+)\s*s", s).group(1)) if re.search(r"(\d+)\s*s", s) else 0
-    return h * 3600 + m_ * 60 + se
+    total = 0
+    for n, unit in _TIME_UNITS_RE.findall(m.group(1)):
+        total += int(n) * _TIME_UNIT_SECONDS[unit]
+    return total
 
 
-def download(url: str, out_path: str):
-    headers = {"User-Agent": "Mozilla/5.0"}
-    r = requests.get(url, headers=headers, timeout=120)
-    r.raise_for_status()
-    with open(out_path, "wb") as f:
-        f.write(r.content)
+def parse_time_seconds(gcode_path: str) -> int:
+    t = _time_seconds_from_text(_read_tail(gcode_path))
+    if t >= 0:
+        return t
+    with open(gcode_path, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            t = _time_seconds_from_text(line)
+            if t >= 0:
+                return t
+    return -1
+
+
+def _parse_gcode_estimates(gcode_path: str, material: str):
+    g = parse_filament_g(gcode_path, material)
+    t = parse_time_seconds(gcode_path)
+
+    # HARD fallback: if parser returns 0 but we can detect extrusion, compute grams from E axis.
+    # Only scanned when actually needed, and the result is shared with the
+    # debug payload instead of rescanning the file.
+    e_len = 0.0
+    if g == 0:
+        e_len = _extrusion_length_mm_from_e_axis(gcode_path)
+        if e_len > 0:
+            g = _calc_grams_from_length_mm(e_len, material)
+
+    return g, t, e_len
+
 
+# Shared client: keep-alive + pooled connections, so repeated estimates
+# against the same storage host skip the TCP/TLS handshake.
+_HTTPX = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    timeout=120,
+    follow_redirects=True,
+)
 
-def slice_with_prusa(model_path: str, out_gcode: str, material: str, quality: str, supports: bool):
-    base = "profiles/base.ini"
-    mat = f"profiles/{material.lower()}.ini"
-    qual = f"profiles/{quality}.ini"
 
-    if not (os.path.exists(base) and os.path.exists(mat) and os.path.exists(qual)):
+# Hard cap on model downloads; anything bigger fails fast with 413 instead
+# of filling the disk (and wasting a slicer run) on adversarial input.
+_MAX_DOWNLOAD_BYTES = 512 * 1024 * 1024
+
+
+async def download(url: str, out_path: str) -> str:
+    # Hash while writing so the cache key costs no second pass over the file.
+    headers = {"User-Agent": "Mozilla/5.0"}
+    h = hashlib.sha256()
+    async with _HTTPX.stream("GET", url, headers=headers) as r:
+        r.raise_for_status()
+        length = r.headers.get("content-length", "")
+        if length.isdigit() and int(length) > _MAX_DOWNLOAD_BYTES:
+            raise HTTPException(413, "file too large")
+        # Without a Content-Encoding there is nothing to decode, so read the
+        # raw stream and skip httpx's per-chunk decoding layer.
+        if "content-encoding" in r.headers:
+            chunks = r.aiter_bytes(1 << 20)
+        else:
+            chunks = r.aiter_raw(1 << 20)
+        total = 0
+        with open(out_path, "wb") as f:
+            async for chunk in chunks:
+                total += len(chunk)
+                if total > _MAX_DOWNLOAD_BYTES:
+                    raise HTTPException(413, "file too large")
+                h.update(chunk)
+                f.write(chunk)
+    return h.hexdigest()
+
+
+# Slicing is deterministic for a given model + parameters, so results are
+# memoized on the model's content hash. Grows a few floats per distinct
+# quote; capped with FIFO eviction.
+_ESTIMATE_CACHE = {}
+_ESTIMATE_CACHE_MAX = 1024
+
+
+# Profile INIs are static, so the base/material/quality triplets are
+# merged once at startup into one key = value file each (later files
+# override earlier ones, matching stacked --load flags). Keys must be
+# written exactly once: PrusaSlicer's INI reader rejects duplicates.
+_PROFILE_DIR = "profiles"
+_MATERIALS = ("pla", "petg")
+_QUALITIES = ("draft", "standard", "fine")
+_MERGED_PROFILES = {}
+
+
+def _ini_has_duplicate_keys(path: str) -> bool:
+    seen = set()
+    with open(path) as f:
+        for line in f:
+            key = line.split("=", 1)[0].strip()
+            if key and not key.startswith(("#", ";")):
+                if key in seen:
+                    return True
+                seen.add(key)
+    return False
+
+
+def _merge_profiles():
+    base = os.path.join(_PROFILE_DIR, "base.ini")
+    for mat in _MATERIALS:
+        for qual in _QUALITIES:
+            parts = [base, os.path.join(_PROFILE_DIR, f"{mat}.ini"), os.path.join(_PROFILE_DIR, f"{qual}.ini")]
+            if not all(os.path.exists(p) for p in parts):
+                continue
+            merged = os.path.join(_PROFILE_DIR, f"_merged_{mat}_{qual}.ini")
+            newest = max(os.path.getmtime(p) for p in parts)
+            # the duplicate check also forces a rewrite of merged files left
+            # behind by the old plain-concatenation format
+            if (not os.path.exists(merged) or os.path.getmtime(merged) < newest
+                    or _ini_has_duplicate_keys(merged)):
+                settings = {}
+                for p in parts:
+                    with open(p) as src:
+                        for line in src:
+                            line = line.strip()
+                            if not line or line.startswith(("#", ";")):
+                                continue
+                            key, sep, val = line.partition("=")
+                            if sep:
+                                settings[key.strip()] = val.strip()
+                with open(merged, "w") as out:
+                    for key, val in settings.items():
+                        out.write(f"{key} = {val}\n")
+            if _ini_has_duplicate_keys(merged):
+                raise RuntimeError(f"duplicate keys in merged profile {merged}")
+            _MERGED_PROFILES[(mat, qual)] = merged
+
+
+_merge_profiles()
+
+
+async def slice_with_prusa(model_path: str, out_gcode: str, material: str, quality: str, supports: bool):
+    merged = _MERGED_PROFILES.get((material.lower(), quality))
+    if merged is None:
         raise RuntimeError("Missing profile files")
 
     cmd = [
         "prusa-slicer",
         "--slice",
-        "--load", base,
-        "--load", mat,
-        "--load", qual,
+        "--load", merged,
     ]
 
     # Enable supports only by adding the flag (no 0/1 values)
@@ -183,13 +488,18 @@ def slice_with_prusa(model_path: str, out_gcode: str, material: str, quality: st
         model_path,
     ]
 
-    p = subprocess.run(cmd, capture_output=True, text=True)
-    if p.returncode != 0:
-        raise RuntimeError((p.stderr or p.stdout)[:1200])
+    # Progress chatter on stdout can run to megabytes; drop it at the fd
+    # level and only keep stderr, decoded lazily on the error path.
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    _, err = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(err.decode("utf-8", "ignore")[:1200])
 
 
 @app.post("/estimate")
-def estimate(payload: Union[Req, str] = Body(...)):
+async def estimate(payload: Union[Req, str] = Body(...)):
     try:
         if isinstance(payload, str):
             req = Req(file_url=payload)
@@ -197,25 +507,38 @@ def estimate(payload: Union[Req, str] = Body(...)):
             req = payload
 
         with tempfile.TemporaryDirectory() as tmp:
-            name = str(req.file_url).split("?")[0].split("/")[-1]
-            if not (name.lower().endswith(".stl") or name.lower().endswith(".3mf")):
+            # urlsplit keeps query/fragment noise (e.g. "?sig=...stl") out of
+            # the extension check and avoids the throwaway split lists
+            name = os.path.basename(urlsplit(str(req.file_url)).path)
+            if not name.lower().endswith(_ALLOWED_EXTS):
                 raise HTTPException(400, "Only STL/3MF supported")
 
             model_path = os.path.join(tmp, name)
             out_gcode = os.path.join(tmp, "out.gcode")
 
-            download(str(req.file_url), model_path)
-            slice_with_prusa(model_path, out_gcode, req.material, req.quality, req.supports)
+            digest = await download(str(req.file_url), model_path)
+
+            # Slicing dominates wall time; a byte-identical model with the
+            # same parameters always slices the same, so check the cache
+            # before invoking PrusaSlicer at all.
+            cache_key = (digest, req.material, req.quality, req.supports)
+            cached = _ESTIMATE_CACHE.get(cache_key)
+            if cached is not None:
+                t, g = cached
+                e_len = 0.0
+            else:
+                await slice_with_prusa(model_path, out_gcode, req.material, req.quality, req.supports)
 
-            gcode = open(out_gcode, "r", encoding="utf-8", errors="ignore").read()
+                # CPU-bound parsing goes to a worker thread so a large
+                # G-code doesn't stall the event loop for other requests
+                g, t, e_len = await asyncio.to_thread(_parse_gcode_estimates, out_gcode, req.material)
 
-            g = parse_filament_g(gcode, req.material)
-            t = parse_time_seconds(gcode)
-            
-            # HARD fallback: if parser returns 0 but we can detect extrusion, compute grams from E axis
-            e_len = _extrusion_length_mm_from_e_axis(gcode)
-            if g == 0 and e_len > 0:
-                g = _calc_grams_from_length_mm(e_len, req.material)
+                # only cache clean results; failures keep going through
+                # the full pipeline so the debug payload stays available
+                if t >= 0 and g > 0:
+                    if len(_ESTIMATE_CACHE) >= _ESTIMATE_CACHE_MAX:
+                        _ESTIMATE_CACHE.pop(next(iter(_ESTIMATE_CACHE)))
+                    _ESTIMATE_CACHE[cache_key] = (t, g)
 
 
             if t < 0:
@@ -227,7 +550,10 @@ def estimate(payload: Union[Req, str] = Body(...)):
             }
 
             if g == 0:
-                resp["debug_header"] = gcode.splitlines()[:60]
+                # cap by bytes as well as lines, so a file with huge/absent
+                # newlines can't drag a giant buffer into the response
+                with open(out_gcode, "r", encoding="utf-8", errors="ignore") as f:
+                    resp["debug_header"] = f.read(65536).splitlines()[:60]
                 resp["debug_e_length_mm"] = e_len
 
 